@@ -0,0 +1,466 @@
+'''
+Evaluation and move search for the computer player.
+
+Scores are in centipawns from white's point of view. Material values and piece-square tables start out
+hand-picked and are replaced at import time by weights.json when it exists (written by ChessTuner.py).
+'''
+
+import json
+import os
+import threading
+import time
+from array import array
+
+CHECKMATE = 100000
+STALEMATE = 0
+DEPTH = 3
+MAX_PLY = 100 #mate scores are within MAX_PLY of CHECKMATE
+TT_SIZE = 1 << 20 #transposition table slots, 17 bytes each
+ANALYSIS_DEPTH = 30 #analysis runs until stopped, in practice never this deep
+EXACT, LOWERBOUND, UPPERBOUND = 0, 1, 2 #kinds of transposition table scores
+WEIGHTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights.json')
+
+#order of piece types matches ChessEngine.pieceCodes, the tuner relies on this
+PIECE_TYPES = ['p', 'N', 'B', 'R', 'Q', 'K']
+
+pieceScores = {'p': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 0}
+
+#tables are from white's point of view with row 0 being the 8th rank, black pieces use them flipped vertically
+pieceSquareScores = {
+    'p': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [50, 50, 50, 50, 50, 50, 50, 50],
+          [10, 10, 20, 30, 30, 20, 10, 10],
+          [5, 5, 10, 25, 25, 10, 5, 5],
+          [0, 0, 0, 20, 20, 0, 0, 0],
+          [5, -5, -10, 0, 0, -10, -5, 5],
+          [5, 10, 10, -20, -20, 10, 10, 5],
+          [0, 0, 0, 0, 0, 0, 0, 0]],
+    'N': [[-50, -40, -30, -30, -30, -30, -40, -50],
+          [-40, -20, 0, 0, 0, 0, -20, -40],
+          [-30, 0, 10, 15, 15, 10, 0, -30],
+          [-30, 5, 15, 20, 20, 15, 5, -30],
+          [-30, 0, 15, 20, 20, 15, 0, -30],
+          [-30, 5, 10, 15, 15, 10, 5, -30],
+          [-40, -20, 0, 5, 5, 0, -20, -40],
+          [-50, -40, -30, -30, -30, -30, -40, -50]],
+    'B': [[-20, -10, -10, -10, -10, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 10, 10, 5, 0, -10],
+          [-10, 5, 5, 10, 10, 5, 5, -10],
+          [-10, 0, 10, 10, 10, 10, 0, -10],
+          [-10, 10, 10, 10, 10, 10, 10, -10],
+          [-10, 5, 0, 0, 0, 0, 5, -10],
+          [-20, -10, -10, -10, -10, -10, -10, -20]],
+    'R': [[0, 0, 0, 0, 0, 0, 0, 0],
+          [5, 10, 10, 10, 10, 10, 10, 5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [-5, 0, 0, 0, 0, 0, 0, -5],
+          [0, 0, 0, 5, 5, 0, 0, 0]],
+    'Q': [[-20, -10, -10, -5, -5, -10, -10, -20],
+          [-10, 0, 0, 0, 0, 0, 0, -10],
+          [-10, 0, 5, 5, 5, 5, 0, -10],
+          [-5, 0, 5, 5, 5, 5, 0, -5],
+          [0, 0, 5, 5, 5, 5, 0, -5],
+          [-10, 5, 5, 5, 5, 5, 0, -10],
+          [-10, 0, 5, 0, 0, 0, 0, -10],
+          [-20, -10, -10, -5, -5, -10, -10, -20]],
+    'K': [[-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-30, -40, -40, -50, -50, -40, -40, -30],
+          [-20, -30, -30, -40, -40, -30, -30, -20],
+          [-10, -20, -20, -20, -20, -20, -20, -10],
+          [20, 20, 0, 0, 0, 0, 20, 20],
+          [20, 30, 10, 0, 0, 10, 30, 20]]
+}
+
+
+def loadWeights(path=WEIGHTS_FILE):
+    '''
+    Replace the material values and piece-square tables with the ones stored in path
+    '''
+    with open(path) as f:
+        weights = json.load(f)
+    pieceScores.update(weights['pieceScores'])
+    pieceSquareScores.update(weights['pieceSquareScores'])
+
+
+def saveWeights(path=WEIGHTS_FILE):
+    with open(path, 'w') as f:
+        json.dump({'pieceScores': pieceScores, 'pieceSquareScores': pieceSquareScores}, f, indent=1)
+
+
+def scoreBoard(gs):
+    '''
+    Score of the position, call after gs.getValidMoves() so checkmate and stalemate are up to date
+    '''
+    if gs.checkmate:
+        return -CHECKMATE if gs.whiteToMove else CHECKMATE
+    if gs.stalemate:
+        return STALEMATE
+    return scoreMaterial(gs.board)
+
+
+def scoreMaterial(board):
+    '''
+    Material plus piece-square score of the board
+    '''
+    score = 0
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece[0] == 'w':
+                score += pieceScores[piece[1]] + pieceSquareScores[piece[1]][row][col]
+            elif piece[0] == 'b':
+                score -= pieceScores[piece[1]] + pieceSquareScores[piece[1]][7 - row][col]
+    return score
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Searcher():
+    '''
+    Iterative deepening negamax with alpha-beta pruning.
+
+    The transposition table, killer moves and history scores are kept from one search to the next, so a new
+    move starts from what was learned on the previous ones. Searches can run on a background thread, and
+    ponder() uses the opponent's thinking time to search the position after their expected reply: on a ponder
+    hit the running search becomes the real one, on a miss it is stopped and thrown away.
+
+    With multiPV above 1 the root keeps exact scores for the best multiPV moves, and a listener is called
+    with the best lines after every completed depth.
+    '''
+    def __init__(self, ttSize=TT_SIZE):
+        self.ttSize = ttSize
+        #transposition table, a position's slot is zobrist key % ttSize. Depth -1 marks an empty slot
+        self.ttKeys = array('Q', [0]) * ttSize
+        self.ttDepths = array('b', [-1]) * ttSize
+        self.ttScores = array('i', [0]) * ttSize
+        self.ttFlags = array('b', [0]) * ttSize
+        self.ttMoves = array('H', [0]) * ttSize #moveID of the best move
+        self.ttAges = array('B', [0]) * ttSize #search that stored the entry, entries of older searches are replaced first
+        self.age = 0
+        self.killerMoves = [[0, 0] for i in range(MAX_PLY)] #two quiet moves per ply that caused a beta cutoff
+        self.history = [[0] * 64 for i in range(64)] #[start square][end square] -> how often the quiet move cut off
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.deadline = None
+        self.timeLimit = None
+        self.pondering = False
+        self.ponderMove = None #reply we expect from the opponent after bestMove
+        self.ponderingOn = None #opponent's move the running ponder search assumes, compare the real reply with it
+        self.bestMove = None
+        self.completedDepth = 0
+        self.nodes = 0
+        self.multiPV = 1
+        self.listener = None #called as listener(depth, [(score, [moves]), ...]) from the searching thread
+
+    def findBestMove(self, gs, validMoves, maxDepth=DEPTH, timeLimit=None):
+        '''
+        Returns the best move of the deepest completed search, stopping after maxDepth or once timeLimit seconds have passed.
+        gs is left as it was passed in
+        '''
+        self.stop()
+        self.deadline = time.time() + timeLimit if timeLimit is not None else None
+        self.pondering = False
+        self.multiPV = 1
+        self.listener = None
+        return self.search(gs, validMoves, maxDepth)
+
+    def startSearch(self, gs, maxDepth=DEPTH, timeLimit=None, ponderMove=None, multiPV=1, listener=None):
+        '''
+        Search a copy of gs on a background thread, poll isDone() and then read bestMove.
+        With ponderMove the copy plays it first and the search runs without a time limit until ponderHit() or stop()
+        '''
+        self.stop()
+        self.multiPV = multiPV
+        self.listener = listener
+        position = gs.clone()
+        if ponderMove is not None:
+            position.makeMove(ponderMove)
+        self.timeLimit = timeLimit
+        self.pondering = ponderMove is not None
+        self.ponderingOn = ponderMove
+        self.deadline = time.time() + timeLimit if timeLimit is not None and not self.pondering else None
+        self.bestMove = None
+        self.thread = threading.Thread(target=self.search, args=(position, position.getValidMoves(), maxDepth), daemon=True)
+        self.thread.start()
+
+    def ponder(self, gs, maxDepth=DEPTH, timeLimit=None):
+        '''
+        Start pondering on the opponent's expected reply from the last search, returns False if there isn't one
+        '''
+        if self.ponderMove is None:
+            return False
+        self.startSearch(gs, maxDepth, timeLimit, self.ponderMove)
+        return True
+
+    def analyse(self, gs, multiPV, listener, maxDepth=ANALYSIS_DEPTH):
+        '''
+        Analyse gs on a background thread until stop(), reporting the best multiPV lines to listener after each depth
+        '''
+        self.startSearch(gs, maxDepth, None, None, multiPV, listener)
+
+    def ponderHit(self):
+        '''
+        The opponent played ponderingOn: keep the running search, now with the normal time limit
+        '''
+        if self.timeLimit is not None:
+            self.deadline = time.time() + self.timeLimit
+        self.pondering = False
+
+    def stop(self):
+        '''
+        Stop a background search and wait for it, e.g. on a ponder miss. The tables are kept
+        '''
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+        self.stopEvent.clear()
+        self.pondering = False
+
+    def isDone(self):
+        '''
+        True once a background search (not pondering) has finished and bestMove can be read
+        '''
+        return self.thread is not None and not self.pondering and not self.thread.is_alive()
+
+    def search(self, gs, validMoves, maxDepth):
+        self.nodes = 0
+        self.completedDepth = 0
+        self.ponderMove = None
+        if len(validMoves) == 0:
+            self.bestMove = None
+            return None
+        self.age = (self.age + 1) % 256
+        for row in self.history: #age the history so older searches count less
+            for i in range(64):
+                row[i] //= 2
+        rootLength = len(gs.moveLog)
+        moves = self.orderMoves(validMoves, self.hashMove(gs), 0)
+        bestMove = moves[0]
+        try:
+            for depth in range(1, maxDepth + 1):
+                if self.multiPV > 1:
+                    lines = self.searchRootMultiPV(gs, moves, depth)
+                    moves = [move for score, move in lines] #next iteration searches them best first
+                    lines = lines[:self.multiPV]
+                else:
+                    lines = [self.searchRoot(gs, moves, depth)]
+                    moves.remove(lines[0][1])
+                    moves.insert(0, lines[0][1]) #search the best move first on the next iteration
+                score, bestMove = lines[0]
+                self.completedDepth = depth
+                if self.listener is not None:
+                    self.listener(depth, self.describeLines(gs, lines))
+                if self.multiPV == 1 and abs(score) >= CHECKMATE - MAX_PLY:
+                    break #found a forced mate, searching deeper won't change the move
+        except SearchTimeout:
+            while len(gs.moveLog) > rootLength: #unwind the moves made by the interrupted search
+                gs.undoMove()
+        principalVariation = self.getPrincipalVariation(gs, 2)
+        self.ponderMove = principalVariation[1] if len(principalVariation) == 2 and principalVariation[0] == bestMove else None
+        gs.getValidMoves() #restore pins, checkmate and stalemate for the root position
+        self.bestMove = bestMove
+        return bestMove
+
+    def searchRoot(self, gs, moves, depth):
+        alpha = -CHECKMATE - 1
+        bestMove = None
+        for move in moves:
+            gs.makeMove(move)
+            score = -self.negamax(gs, depth - 1, -CHECKMATE - 1, -alpha, 1)
+            gs.undoMove()
+            if score > alpha:
+                alpha = score
+                bestMove = move
+        self.storeEntry(gs.getZobristKey(), depth, alpha, EXACT, bestMove.moveID, 0)
+        return alpha, bestMove
+
+    def searchRootMultiPV(self, gs, moves, depth):
+        '''
+        Search every root move in one pass, with alpha at the multiPV-th best score so far so the moves that make
+        the top multiPV get exact scores. Returns all (score, move) pairs, best first
+        '''
+        scored = []
+        for move in moves:
+            if len(scored) >= self.multiPV:
+                alpha = sorted([score for score, m in scored], reverse=True)[self.multiPV - 1]
+            else:
+                alpha = -CHECKMATE - 1
+            gs.makeMove(move)
+            score = -self.negamax(gs, depth - 1, -CHECKMATE - 1, -alpha, 1)
+            gs.undoMove()
+            scored.append((score, move))
+        scored.sort(key=lambda line: -line[0])
+        self.storeEntry(gs.getZobristKey(), depth, scored[0][0], EXACT, scored[0][1].moveID, 0)
+        return scored
+
+    def describeLines(self, gs, lines):
+        '''
+        Turns (score, root move) pairs into (score, principal variation) pairs
+        '''
+        described = []
+        for score, move in lines:
+            gs.makeMove(move)
+            described.append((score, [move] + self.getPrincipalVariation(gs, self.completedDepth - 1)))
+            gs.undoMove()
+        return described
+
+    def negamax(self, gs, depth, alpha, beta, ply):
+        '''
+        Score of the position for the side to move
+        '''
+        self.nodes += 1
+        if self.stopEvent.is_set() or (self.deadline is not None and time.time() > self.deadline):
+            raise SearchTimeout()
+        if depth == 0:
+            return (1 if gs.whiteToMove else -1) * scoreMaterial(gs.board)
+
+        key = gs.getZobristKey()
+        entry = self.probe(key)
+        hashMove = 0
+        if entry is not None:
+            entryDepth, score, flag, hashMove = entry
+            if entryDepth >= depth:
+                score = scoreFromTable(score, ply)
+                if flag == EXACT or (flag == LOWERBOUND and score >= beta) or (flag == UPPERBOUND and score <= alpha):
+                    return score
+
+        moves = gs.getValidMoves()
+        if len(moves) == 0:
+            return -CHECKMATE + ply if gs.checkmate else STALEMATE
+
+        originalAlpha = alpha
+        bestScore = -CHECKMATE - 1
+        bestMove = None
+        for move in self.orderMoves(moves, hashMove, ply):
+            gs.makeMove(move)
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            gs.undoMove()
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+                if score > alpha:
+                    alpha = score
+            if alpha >= beta:
+                if move.pieceCaptured == '--': #remember quiet moves that refute a position
+                    if self.killerMoves[ply][0] != move.moveID:
+                        self.killerMoves[ply][1] = self.killerMoves[ply][0]
+                        self.killerMoves[ply][0] = move.moveID
+                    self.history[move.startRow * 8 + move.startCol][move.endRow * 8 + move.endCol] += depth * depth
+                break
+
+        if bestScore <= originalAlpha:
+            flag = UPPERBOUND
+        elif bestScore >= beta:
+            flag = LOWERBOUND
+        else:
+            flag = EXACT
+        self.storeEntry(key, depth, bestScore, flag, bestMove.moveID, ply)
+        return bestScore
+
+    def probe(self, key):
+        '''
+        Returns (depth, score, flag, moveID) stored for key, or None
+        '''
+        i = key % self.ttSize
+        if self.ttDepths[i] < 0 or self.ttKeys[i] != key:
+            return None
+        return self.ttDepths[i], self.ttScores[i], self.ttFlags[i], self.ttMoves[i]
+
+    def storeEntry(self, key, depth, score, flag, moveID, ply):
+        '''
+        Depth-preferred replacement: a slot keeps its entry from the current search unless the new one is at least as deep
+        '''
+        i = key % self.ttSize
+        if self.ttDepths[i] > depth and self.ttAges[i] == self.age:
+            return
+        self.ttKeys[i] = key
+        self.ttDepths[i] = depth
+        self.ttScores[i] = scoreToTable(score, ply)
+        self.ttFlags[i] = flag
+        self.ttMoves[i] = moveID
+        self.ttAges[i] = self.age
+
+    def hashMove(self, gs):
+        entry = self.probe(gs.getZobristKey())
+        return entry[3] if entry is not None else 0
+
+    def orderMoves(self, moves, hashMove, ply):
+        '''
+        Hash move, then captures (most valuable victim, least valuable attacker), then killer moves, then by history.
+        The search always promotes to a queen
+        '''
+        killers = self.killerMoves[ply] if ply < MAX_PLY else [0, 0]
+        def moveOrder(move):
+            if move.moveID == hashMove:
+                return -1000000
+            if move.pieceCaptured != '--':
+                return -100000 - 10 * pieceScores[move.pieceCaptured[1]] + pieceScores[move.pieceMoved[1]]
+            if move.moveID == killers[0] or move.moveID == killers[1]:
+                return -50000
+            return -self.history[move.startRow * 8 + move.startCol][move.endRow * 8 + move.endCol]
+        for move in moves:
+            if move.isPawnPromotion and move.promotionChoice is None:
+                move.promotionChoice = 'Q'
+        return sorted(moves, key=moveOrder)
+
+    def getPrincipalVariation(self, gs, maxLength=MAX_PLY):
+        '''
+        Best line from gs according to the transposition table. gs is left as it was passed in
+        '''
+        line = []
+        seen = set()
+        while len(line) < maxLength:
+            key = gs.getZobristKey()
+            entry = self.probe(key)
+            if entry is None or key in seen:
+                break
+            seen.add(key)
+            move = next((m for m in gs.getValidMoves() if m.moveID == entry[3]), None)
+            if move is None:
+                break
+            if move.isPawnPromotion and move.promotionChoice is None:
+                move.promotionChoice = 'Q'
+            line.append(move)
+            gs.makeMove(move)
+        for i in range(len(line)):
+            gs.undoMove()
+        return line
+
+
+def scoreToTable(score, ply):
+    '''
+    Mate scores are stored relative to the node so they stay right when reached from another ply
+    '''
+    if score >= CHECKMATE - MAX_PLY:
+        return score + ply
+    if score <= -CHECKMATE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def scoreFromTable(score, ply):
+    if score >= CHECKMATE - MAX_PLY:
+        return score - ply
+    if score <= -CHECKMATE + MAX_PLY:
+        return score + ply
+    return score
+
+
+defaultSearcher = Searcher() #shared so repeated calls in one process reuse the tables
+
+
+def findBestMove(gs, validMoves, maxDepth=DEPTH, timeLimit=None):
+    return defaultSearcher.findBestMove(gs, validMoves, maxDepth, timeLimit)
+
+
+if os.path.exists(WEIGHTS_FILE):
+    loadWeights()
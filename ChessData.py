@@ -0,0 +1,298 @@
+'''
+Compact binary storage for training data.
+
+Every (position, move, result, eval) sample is packed into one fixed-width record (see RECORD_DTYPE).
+Records are appended to shard files in a directory, and index.json lists the shards and how many
+records in each one are complete. Shards are never rewritten: a new writer always starts a new shard.
+Several writers can share a directory, each one creates its shards under the next free name and merges
+its record counts into index.json while holding index.lock.
+
+The loader memory-maps the shards and hands out shuffled numpy batches, so no Python object is
+created per record when reading.
+'''
+
+import json
+import os
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: #windows
+    fcntl = None
+    import msvcrt
+
+import ChessEngine
+
+RECORD_DTYPE = np.dtype([
+    ('board', np.uint8, (32,)), #nibble packed squares, see ChessEngine.pieceCodes
+    ('flags', np.uint8),        #bit 0 is white to move, bits 1-4 are CastleRights.toBits()
+    ('enPassant', np.uint8),    #column of the en passant square, NO_EN_PASSANT if there isn't one
+    ('move', '<u2'),            #Move.toInt() of the move played
+    ('result', np.int8),        #1 white won, 0 draw, -1 black won
+    ('eval', '<i2'),            #centipawns from white's point of view
+])
+
+NO_EN_PASSANT = 255
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+INDEX_VERSION = 1
+
+
+def readIndex(directory):
+    '''
+    Returns the shard index of a data directory, or an empty one if nothing has been written yet
+    '''
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return {'version': INDEX_VERSION, 'recordSize': RECORD_DTYPE.itemsize, 'shards': []}
+    with open(path) as f:
+        index = json.load(f)
+    if index['recordSize'] != RECORD_DTYPE.itemsize:
+        raise ValueError('%s was written with %d byte records, expected %d' % (path, index['recordSize'], RECORD_DTYPE.itemsize))
+    return index
+
+
+def writeIndex(directory, index):
+    '''
+    Replace the index atomically so a reader never sees a half written file
+    '''
+    path = os.path.join(directory, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def lockIndex(directory):
+    '''
+    Hold an exclusive lock on the index of directory, for writers updating it from several processes
+    '''
+    with open(os.path.join(directory, LOCK_FILE), 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def encodePosition(gs, move, result, evaluation=0):
+    '''
+    Returns the record for the position in gs with move about to be played
+    '''
+    record = np.zeros((), RECORD_DTYPE)
+    record['board'] = np.frombuffer(gs.packBoard(), np.uint8)
+    record['flags'] = int(gs.whiteToMove) | gs.currentCastlingRights.toBits() << 1
+    enPassantCol = gs.getEnPassantCol()
+    record['enPassant'] = enPassantCol if enPassantCol >= 0 else NO_EN_PASSANT
+    record['move'] = move.toInt()
+    record['result'] = result
+    record['eval'] = max(-32767, min(32767, int(evaluation)))
+    return record
+
+
+def decodeBoards(records):
+    '''
+    Unpacks the board field of a batch of records into an (N, 64) array of piece codes
+    '''
+    packed = records['board']
+    squares = np.empty((len(records), 64), np.uint8)
+    squares[:, 0::2] = packed & 15
+    squares[:, 1::2] = packed >> 4
+    return squares
+
+
+def toPlanes(records):
+    '''
+    Turns a batch of records into (N, 12, 8, 8) float32 one-hot piece planes, white pieces first
+    '''
+    squares = decodeBoards(records)
+    planes = np.zeros((len(records), 12, 64), np.float32)
+    rows, cols = np.nonzero(squares)
+    codes = squares[rows, cols]
+    planes[rows, (codes & 7) - 1 + 6 * (codes >> 3), cols] = 1.0
+    return planes.reshape(len(records), 12, 8, 8)
+
+
+class ShardWriter():
+    '''
+    Appends records to a new shard in directory, starting another shard once recordsPerShard is reached
+    '''
+    def __init__(self, directory, recordsPerShard=1 << 22, bufferSize=1 << 14):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.recordsPerShard = recordsPerShard
+        self.shards = [] #{'file', 'records'} of the shards this writer created
+        self.buffer = np.zeros(bufferSize, RECORD_DTYPE)
+        self.buffered = 0
+        self.shardFile = None
+        self.shardEntry = None
+
+    def addPosition(self, gs, move, result, evaluation=0):
+        self.buffer[self.buffered] = encodePosition(gs, move, result, evaluation)
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def addGame(self, moves, result, evals=None):
+        '''
+        Replays moves (e.g. a finished game's moveLog) from the starting position and records every position
+        '''
+        gs = ChessEngine.GameState()
+        for i in range(len(moves)):
+            self.addPosition(gs, moves[i], result, evals[i] if evals is not None else 0)
+            gs.makeMove(moves[i])
+
+    def addRecords(self, records):
+        '''
+        Appends an array of records that are already encoded
+        '''
+        self.flush()
+        self.writeRecords(np.asarray(records, RECORD_DTYPE))
+
+    def flush(self):
+        if self.buffered:
+            self.writeRecords(self.buffer[:self.buffered])
+            self.buffered = 0
+
+    def writeRecords(self, records):
+        while len(records):
+            if self.shardFile is None or self.shardEntry['records'] == self.recordsPerShard:
+                self.startShard()
+            count = min(len(records), self.recordsPerShard - self.shardEntry['records'])
+            self.shardFile.write(records[:count].tobytes())
+            self.shardFile.flush()
+            os.fsync(self.shardFile.fileno())
+            self.shardEntry['records'] += count
+            records = records[count:]
+        self.updateIndex() #records only count once their bytes are on disk
+
+    def updateIndex(self):
+        '''
+        Merge the record counts of this writer's shards into the index on disk, other writers may have changed it
+        '''
+        with lockIndex(self.directory):
+            index = readIndex(self.directory)
+            entries = {entry['file']: entry for entry in index['shards']}
+            for shard in self.shards:
+                if shard['file'] in entries:
+                    entries[shard['file']]['records'] = shard['records']
+                else:
+                    index['shards'].append(dict(shard))
+            writeIndex(self.directory, index)
+
+    def startShard(self):
+        if self.shardFile is not None:
+            self.shardFile.close()
+        number = len(readIndex(self.directory)['shards'])
+        while True: #'xb' fails if the name is taken, by another writer or a shard left out of the index by a crash
+            name = 'shard-%06d.bin' % number
+            try:
+                self.shardFile = open(os.path.join(self.directory, name), 'xb')
+                break
+            except FileExistsError:
+                number += 1
+        self.shardEntry = {'file': name, 'records': 0}
+        self.shards.append(self.shardEntry)
+        self.updateIndex()
+
+    def close(self):
+        self.flush()
+        if self.shardFile is not None:
+            self.shardFile.close()
+            self.shardFile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardLoader():
+    '''
+    Yields shuffled batches of records from memory-mapped shards.
+
+    Shuffling is done in two levels so memory stays bounded for any number of records: blocks of blockSize
+    consecutive records are visited in random order, and mixBlocks blocks at a time are shuffled together.
+    Batches are gathered (and passed through transform, e.g. toPlanes) on a pool of worker threads ahead of
+    the consumer. Numpy releases the GIL while copying, so the gathering uses all cores.
+
+    rank and worldSize split the shards between several training processes.
+    '''
+    def __init__(self, directory, batchSize=1024, shuffle=True, seed=None, transform=None, workers=None,
+                 blockSize=1 << 16, mixBlocks=16, rank=0, worldSize=1):
+        index = readIndex(directory)
+        self.shards = []
+        for entry in index['shards'][rank::worldSize]:
+            if entry['records'] > 0:
+                self.shards.append(np.memmap(os.path.join(directory, entry['file']), RECORD_DTYPE, mode='r', shape=(entry['records'],)))
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.seed = seed
+        self.transform = transform
+        self.workers = workers or os.cpu_count() or 1
+        self.blockSize = blockSize
+        self.mixBlocks = mixBlocks
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def gather(self, indices):
+        '''
+        Copies the records at the given global indices into a new array, keeping their order
+        '''
+        batch = np.empty(len(indices), RECORD_DTYPE)
+        shardIds = np.searchsorted(self.offsets, indices, side='right') - 1
+        for shardId in np.unique(shardIds):
+            mask = shardIds == shardId
+            batch[mask] = self.shards[shardId][indices[mask] - self.offsets[shardId]]
+        return self.transform(batch) if self.transform is not None else batch
+
+    def batchIndices(self, epoch):
+        rng = np.random.default_rng(None if self.seed is None else self.seed + epoch)
+        starts = np.arange(0, len(self), self.blockSize)
+        if self.shuffle:
+            rng.shuffle(starts)
+        leftover = np.empty(0, np.int64)
+        for i in range(0, len(starts), self.mixBlocks):
+            indices = np.concatenate([np.arange(start, min(start + self.blockSize, len(self)), dtype=np.int64) for start in starts[i:i + self.mixBlocks]])
+            if self.shuffle:
+                rng.shuffle(indices)
+            indices = np.concatenate([leftover, indices])
+            end = len(indices) - len(indices) % self.batchSize
+            for j in range(0, end, self.batchSize):
+                yield indices[j:j + self.batchSize]
+            leftover = indices[end:]
+        if len(leftover):
+            yield leftover
+
+    def batches(self, epoch=0):
+        '''
+        Generator over one pass of the data, pass a different epoch for a different shuffle
+        '''
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for indices in self.batchIndices(epoch):
+                pending.append(pool.submit(self.gather, indices))
+                if len(pending) > 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def __iter__(self):
+        return self.batches()
@@ -0,0 +1,345 @@
+'''
+Position index over large game collections.
+
+Every game is replayed once through GameState, and each position it passes through is recorded as
+(Zobrist key, move played, white wins, draws, black wins). Batches of games are written as sorted runs: a file
+of keys and a file of move counts with one row per (position, move). A lookup memory-maps the runs and binary
+searches the key file of each one, so it only touches a few pages whatever the size of the collection.
+
+Adding games never rewrites existing runs. Runs are compacted in tiers: a run of n rows is in tier
+log(n) / log(fanout), and once a tier holds fanout runs they are merged into one run of the next tier, with
+the counts of equal (position, move) rows added together. The merge streams through the sorted runs a chunk
+at a time, so its memory doesn't grow with the size of the database.
+
+Usage:
+    python ChessDatabase.py add <directory> <games.pgn> [...]
+    python ChessDatabase.py compact <directory>
+    python ChessDatabase.py query <directory> [fen]
+'''
+
+import argparse
+import itertools
+import json
+import math
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ChessEngine
+
+KEY_DTYPE = np.dtype('<u8')
+COUNTS_DTYPE = np.dtype([('move', '<u2'), ('white', '<u4'), ('draw', '<u4'), ('black', '<u4')])
+RUNS_FILE = 'runs.json'
+TIER_FANOUT = 4 #runs of a tier that are merged together
+MERGE_CHUNK = 1 << 18 #rows read from each run at a time when merging
+GAMES_PER_RUN = 100000
+GAMES_PER_CHUNK = 500 #games replayed by a worker process at a time
+
+RESULTS = {'1-0': 1, '1/2-1/2': 0, '0-1': -1}
+
+
+def readPgn(lines):
+    '''
+    Yields (SAN moves, result) for each game in PGN text, games without a result are skipped
+    '''
+    moveText = []
+    result = None
+    inComment = False #inside a { } comment that started on an earlier line
+    for line in lines:
+        line = line.strip()
+        if line.startswith('[') and not inComment:
+            if moveText: #headers of the next game
+                yield from parseMoveText(' '.join(moveText), result)
+                moveText = []
+                result = None
+            match = re.match(r'\[Result "(.*)"\]', line)
+            if match:
+                result = RESULTS.get(match.group(1))
+        elif line and not line.startswith('%'):
+            line, inComment = stripComments(line, inComment)
+            moveText.append(line)
+    if moveText:
+        yield from parseMoveText(' '.join(moveText), result)
+
+
+def stripComments(line, inComment):
+    '''
+    Remove { } comments and the ; comment that runs to the end of the line, returns (text, still in a { } comment)
+    '''
+    text = []
+    for char in line:
+        if inComment:
+            inComment = char != '}'
+        elif char == '{':
+            inComment = True
+            text.append(' ')
+        elif char == ';':
+            break
+        else:
+            text.append(char)
+    return ''.join(text), inComment
+
+
+def parseMoveText(text, result):
+    text = re.sub(r'\$\d+', ' ', text) #annotation glyphs, readPgn already removed the comments
+    while '(' in text: #variations, innermost first
+        text = re.sub(r'\([^()]*\)', ' ', text)
+    moves = []
+    for token in text.split():
+        if token in RESULTS or token == '*':
+            result = RESULTS.get(token, result)
+            continue
+        token = re.sub(r'^\d+\.+', '', token) #move numbers, also when glued to the move
+        if token:
+            moves.append(token)
+    if result is not None:
+        yield moves, result
+
+
+def sanToMove(san, validMoves):
+    '''
+    Returns the valid move written in standard algebraic notation, or None
+    '''
+    san = san.rstrip('+#!?')
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        endCol = 6 if len(san) == 3 else 2
+        for move in validMoves:
+            if move.isCastleMove and move.endCol == endCol:
+                return move
+        return None
+    promotion = None
+    match = re.match(r'^(.*?)=?([QRBN])$', san)
+    if match and san[0] not in 'KQRBN':
+        san, promotion = match.group(1), match.group(2)
+    piece = san[0] if san[0] in 'KQRBN' else 'p'
+    body = (san[1:] if piece != 'p' else san).replace('x', '')
+    if len(body) < 2:
+        return None
+    end = body[-2:]
+    hints = body[:-2] #disambiguation, a file, a rank or both
+    for move in validMoves:
+        if move.pieceMoved[1] != piece or move.getRankFile(move.endRow, move.endCol) != end:
+            continue
+        start = move.getRankFile(move.startRow, move.startCol)
+        if all(hint in start for hint in hints):
+            if move.isPawnPromotion:
+                move.promotionChoice = promotion or 'Q'
+            return move
+    return None
+
+
+def replayGames(games):
+    '''
+    Replay (SAN moves, result) games, returns arrays of position keys, packed moves and results.
+    Runs in the worker processes of PositionIndex.addGames
+    '''
+    keys = []
+    moves = []
+    results = []
+    for sanMoves, result in games:
+        gs = ChessEngine.GameState()
+        for san in sanMoves:
+            move = sanToMove(san, gs.getValidMoves())
+            if move is None:
+                break #illegal or unreadable, keep the positions before it
+            keys.append(gs.getZobristKey())
+            moves.append(move.toInt())
+            results.append(result)
+            gs.makeMove(move)
+    return np.array(keys, KEY_DTYPE), np.array(moves, np.uint16), np.array(results, np.int8)
+
+
+def aggregate(keys, counts):
+    '''
+    Sort rows by (key, move) and add up the counts of equal rows
+    '''
+    order = np.lexsort((counts['move'], keys))
+    keys = keys[order]
+    counts = counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate([[True], (keys[1:] != keys[:-1]) | (counts['move'][1:] != counts['move'][:-1])]))
+    merged = np.empty(len(starts), COUNTS_DTYPE)
+    merged['move'] = counts['move'][starts]
+    for field in ('white', 'draw', 'black'):
+        merged[field] = np.add.reduceat(counts[field].astype(np.uint64), starts)
+    return keys[starts], merged
+
+
+class PositionIndex():
+    def __init__(self, directory, fanout=TIER_FANOUT):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fanout = fanout
+        self.runs = []
+        self.mapped = [] #(keys, counts) memory maps of each run
+        path = os.path.join(directory, RUNS_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)['runs']
+        self.mapRuns()
+
+    def mapRuns(self):
+        self.mapped = []
+        for run in self.runs:
+            if run['rows'] > 0:
+                keys = np.memmap(os.path.join(self.directory, run['name'] + '.keys'), KEY_DTYPE, mode='r', shape=(run['rows'],))
+                counts = np.memmap(os.path.join(self.directory, run['name'] + '.counts'), COUNTS_DTYPE, mode='r', shape=(run['rows'],))
+                self.mapped.append((keys, counts))
+
+    def saveRuns(self):
+        path = os.path.join(self.directory, RUNS_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'runs': self.runs}, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def nextRunName(self):
+        return 'run-%06d' % (max([int(run['name'][4:]) for run in self.runs], default=0) + 1)
+
+    def writeRun(self, keys, counts):
+        name = self.nextRunName()
+        keys.astype(KEY_DTYPE).tofile(os.path.join(self.directory, name + '.keys'))
+        counts.astype(COUNTS_DTYPE).tofile(os.path.join(self.directory, name + '.counts'))
+        return {'name': name, 'rows': len(keys)}
+
+    def mergeRuns(self, runs):
+        '''
+        k-way merge of sorted runs into a new run, adding up equal (key, move) rows. Each step takes every row with
+        a key up to the smallest last key of the next MERGE_CHUNK rows of each run, so a position never spans two steps
+        '''
+        mapped = []
+        for run in runs:
+            if run['rows'] > 0:
+                mapped.append((np.memmap(os.path.join(self.directory, run['name'] + '.keys'), KEY_DTYPE, mode='r', shape=(run['rows'],)),
+                               np.memmap(os.path.join(self.directory, run['name'] + '.counts'), COUNTS_DTYPE, mode='r', shape=(run['rows'],))))
+        positions = [0] * len(mapped)
+        name = self.nextRunName()
+        rows = 0
+        with open(os.path.join(self.directory, name + '.keys'), 'wb') as keysFile, open(os.path.join(self.directory, name + '.counts'), 'wb') as countsFile:
+            while True:
+                active = [i for i in range(len(mapped)) if positions[i] < len(mapped[i][0])]
+                if len(active) == 0:
+                    break
+                boundary = min(mapped[i][0][min(positions[i] + MERGE_CHUNK, len(mapped[i][0])) - 1] for i in active)
+                keyParts = []
+                countParts = []
+                for i in active:
+                    keys, counts = mapped[i]
+                    end = positions[i] + int(np.searchsorted(keys[positions[i]:], boundary, side='right'))
+                    keyParts.append(keys[positions[i]:end])
+                    countParts.append(counts[positions[i]:end])
+                    positions[i] = end
+                keys, counts = aggregate(np.concatenate(keyParts), np.concatenate(countParts))
+                keys.tofile(keysFile)
+                counts.tofile(countsFile)
+                rows += len(keys)
+        return {'name': name, 'rows': rows}
+
+    def addGames(self, games, gamesPerRun=GAMES_PER_RUN, workers=None):
+        '''
+        Replay (SAN moves, result) games on a pool of processes and add their positions, one run per gamesPerRun games.
+        Returns the number of games read
+        '''
+        games = iter(games)
+        added = 0
+        with ProcessPoolExecutor(workers) as pool:
+            while True:
+                batch = list(itertools.islice(games, gamesPerRun))
+                if len(batch) == 0:
+                    break
+                replayed = list(pool.map(replayGames, [batch[i:i + GAMES_PER_CHUNK] for i in range(0, len(batch), GAMES_PER_CHUNK)]))
+                self.addPositions(np.concatenate([keys for keys, moves, results in replayed]),
+                                  np.concatenate([moves for keys, moves, results in replayed]),
+                                  np.concatenate([results for keys, moves, results in replayed]))
+                added += len(batch)
+        return added
+
+    def addPositions(self, keys, moves, results):
+        if len(keys) == 0:
+            return
+        counts = np.zeros(len(keys), COUNTS_DTYPE)
+        counts['move'] = moves
+        counts['white'] = results == 1
+        counts['draw'] = results == 0
+        counts['black'] = results == -1
+        keys, counts = aggregate(keys, counts)
+        self.runs.append(self.writeRun(keys, counts))
+        self.saveRuns()
+        while True: #a merge can fill up the next tier
+            tiers = {}
+            for run in self.runs:
+                tiers.setdefault(self.tier(run), []).append(run)
+            full = [runs for tier, runs in sorted(tiers.items()) if len(runs) >= self.fanout]
+            if len(full) == 0:
+                break
+            self.replaceRuns(full[0])
+        self.mapRuns()
+
+    def tier(self, run):
+        return int(math.log(max(run['rows'], 1), self.fanout))
+
+    def replaceRuns(self, runs):
+        '''
+        Merge runs into one and delete them once the index lists the merged run instead
+        '''
+        merged = self.mergeRuns(runs)
+        names = set(run['name'] for run in runs)
+        self.runs = [run for run in self.runs if run['name'] not in names] + [merged]
+        self.saveRuns()
+        self.mapped = []
+        for name in names:
+            for extension in ('.keys', '.counts'):
+                os.remove(os.path.join(self.directory, name + extension))
+
+    def compact(self):
+        '''
+        Merge all runs into one
+        '''
+        if len(self.runs) > 1:
+            self.replaceRuns(self.runs)
+        self.mapRuns()
+
+    def lookup(self, gs):
+        '''
+        Moves played from the position in gs: list of (Move, white wins, draws, black wins), most played first
+        '''
+        key = np.uint64(gs.getZobristKey())
+        totals = {}
+        for keys, counts in self.mapped:
+            start = np.searchsorted(keys, key, side='left')
+            end = np.searchsorted(keys, key, side='right')
+            for row in counts[start:end]:
+                white, draw, black = totals.get(int(row['move']), (0, 0, 0))
+                totals[int(row['move'])] = (white + int(row['white']), draw + int(row['draw']), black + int(row['black']))
+        stats = [(ChessEngine.Move.fromInt(move, gs.board),) + counts for move, counts in totals.items()]
+        stats.sort(key=lambda line: -sum(line[1:]))
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index positions of PGN games and look up the moves played from them')
+    parser.add_argument('command', choices=['add', 'compact', 'query'])
+    parser.add_argument('directory')
+    parser.add_argument('args', nargs='*', help='PGN files for add, a FEN for query (default is the starting position)')
+    parser.add_argument('--workers', type=int, default=None, help='processes replaying games, defaults to the number of cores')
+    args = parser.parse_args()
+
+    index = PositionIndex(args.directory)
+    if args.command == 'add':
+        for path in args.args:
+            with open(path, errors='replace') as f:
+                print('%s: %d games' % (path, index.addGames(readPgn(f), workers=args.workers)))
+    elif args.command == 'compact':
+        index.compact()
+    else:
+        gs = ChessEngine.GameState()
+        if args.args:
+            gs.loadFen(' '.join(args.args))
+        for move, white, draw, black in index.lookup(gs):
+            print('%s %d games: +%d =%d -%d' % (move.getChessNotation(), white + draw + black, white, draw, black))
+
+
+if __name__ == "__main__":
+    main()
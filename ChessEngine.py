@@ -5,6 +5,36 @@ Also responsible for determining valid moves. Will also maintain move log.
 '''
 
 import copy
+import random
+from collections import namedtuple
+
+#4-bit piece codes used when packing a board, high bit is the color (set for black)
+pieceCodes = {'--': 0, 'wp': 1, 'wN': 2, 'wB': 3, 'wR': 4, 'wQ': 5, 'wK': 6,
+              'bp': 9, 'bN': 10, 'bB': 11, 'bR': 12, 'bQ': 13, 'bK': 14}
+codePieces = {v: k for k, v in pieceCodes.items()}
+
+#random keys for Zobrist hashing, the seed is fixed so every process computes the same hashes
+zobristRandom = random.Random(2020)
+zobristPieces = {piece: [zobristRandom.getrandbits(64) for i in range(64)] for piece in pieceCodes if piece != '--'}
+zobristCastling = [zobristRandom.getrandbits(64) for i in range(16)] #indexed by CastleRights.toBits()
+zobristEnPassant = [zobristRandom.getrandbits(64) for i in range(8)] #indexed by column
+zobristBlackToMove = zobristRandom.getrandbits(64)
+
+def unpackBoard(packed):
+    '''
+    Inverse of GameState.packBoard, returns a new 8x8 board
+    '''
+    board = []
+    for row in range(8):
+        boardRow = []
+        for byte in packed[row * 4:row * 4 + 4]:
+            boardRow.append(codePieces[byte & 15])
+            boardRow.append(codePieces[byte >> 4])
+        board.append(boardRow)
+    return board
+
+#everything needed to rebuild a position, small enough to send to another process
+Snapshot = namedtuple('Snapshot', ['board', 'whiteToMove', 'castling', 'enPassantCol', 'halfmoveClock', 'fullmoveNumber', 'zobristKey'])
 
 class GameState():
     def __init__(self):
@@ -45,6 +75,10 @@ class GameState():
         self.stalemate = False
 
         self.enPassantPossible = () #coordinates for square where enpassant capture is possible
+        self.enPassantLog = [self.enPassantPossible]
+
+        self.halfmoveClockLog = [0] #moves since the last capture or pawn move, for the 50 move rule
+        self.startPly = 0 #half moves played before the first move in moveLog
         
         self.currentCastlingRights = CastleRights(True, True, True, True)
 
@@ -69,8 +103,9 @@ class GameState():
 
         #pawn promotion
         if move.isPawnPromotion:
-            promotedPiece = input("Promote to Q, R, B, or N: ") 
-            self.board[move.endRow][move.endCol] = move.pieceMoved[0] + promotedPiece
+            if not move.promotionChoice:
+                move.promotionChoice = input("Promote to Q, R, B, or N: ") #kept on the move so it can be compared and packed
+            self.board[move.endRow][move.endCol] = move.pieceMoved[0] + move.promotionChoice
 
         #en passant move
         if move.isEnPassantMove:
@@ -81,6 +116,10 @@ class GameState():
             self.enPassantPossible = ((move.startRow + move.endRow)//2, move.startCol)
         else:
             self.enPassantPossible = ()
+        self.enPassantLog.append(self.enPassantPossible)
+
+        #reset the halfmove clock on pawn moves and captures
+        self.halfmoveClockLog.append(0 if move.pieceMoved[1] == 'p' or move.pieceCaptured != '--' else self.halfmoveClockLog[-1] + 1)
 
         #castle move
         if move.isCastleMove:
@@ -117,11 +156,11 @@ class GameState():
             if move.isEnPassantMove:
                 self.board[move.endRow][move.endCol] = '--' #leave landing square blank
                 self.board[move.startRow][move.endCol] = move.pieceCaptured
-                self.enPassantPossible = (move.endRow, move.endCol)
 
-            #undo a 2 square pawn advance
-            if move.pieceMoved[1] == 'p' and abs(move.startRow - move.endRow) == 2:
-                self.enPassantPossible = ()
+            #restore the en passant square from before the move
+            self.enPassantLog.pop()
+            self.enPassantPossible = self.enPassantLog[-1]
+            self.halfmoveClockLog.pop()
         
             #undo castling rights
             self.castleRightsLog.pop() #get rid of new castle rights from move we are undoing
@@ -176,6 +215,135 @@ class GameState():
                     self.currentCastlingRights.bks = False
 
 
+    def packBoard(self):
+        '''
+        Returns the board as 32 bytes, two squares per byte (low nibble first), squares in row-major order from a8 to h1
+        '''
+        packed = bytearray(32)
+        for row in range(8):
+            for col in range(0, 8, 2):
+                packed[row * 4 + col // 2] = pieceCodes[self.board[row][col]] | (pieceCodes[self.board[row][col + 1]] << 4)
+        return bytes(packed)
+
+    def loadPacked(self, packed, whiteToMove, castling, enPassantCol, halfmoveClock=0, fullmoveNumber=1):
+        '''
+        Set up the position from packBoard() output, CastleRights.toBits() and getEnPassantCol(). Clears the move log
+        '''
+        self.setPosition(unpackBoard(packed), whiteToMove, castling, enPassantCol, halfmoveClock, fullmoveNumber)
+
+    def setPosition(self, board, whiteToMove, castling, enPassantCol, halfmoveClock, fullmoveNumber):
+        self.board = board
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col] == 'wK':
+                    self.whiteKingLocation = (row, col)
+                elif self.board[row][col] == 'bK':
+                    self.blackKingLocation = (row, col)
+        self.whiteToMove = whiteToMove
+        self.moveLog = []
+        self.currentCastlingRights = CastleRights.fromBits(castling)
+        self.castleRightsLog = [CastleRights.fromBits(castling)]
+        if enPassantCol >= 0:
+            self.enPassantPossible = (2 if whiteToMove else 5, enPassantCol)
+        else:
+            self.enPassantPossible = ()
+        self.enPassantLog = [self.enPassantPossible]
+        self.halfmoveClockLog = [halfmoveClock]
+        self.startPly = 2 * (fullmoveNumber - 1) + (0 if whiteToMove else 1)
+        self.checkmate = False
+        self.stalemate = False
+
+    def loadFen(self, fen):
+        '''
+        Set up the position from a FEN string, missing trailing fields get their usual defaults. Clears the move log
+        '''
+        fields = fen.split()
+        board = []
+        for rank in fields[0].split('/'):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(['--'] * int(char))
+                else:
+                    row.append(('w' if char.isupper() else 'b') + ('p' if char in 'pP' else char.upper()))
+            board.append(row)
+        whiteToMove = len(fields) < 2 or fields[1] == 'w'
+        castling = 0
+        for char in (fields[2] if len(fields) > 2 else '-'):
+            castling |= {'K': 1, 'Q': 2, 'k': 4, 'q': 8}.get(char, 0)
+        enPassantCol = Move.filesToCols[fields[3][0]] if len(fields) > 3 and fields[3] != '-' else -1
+        halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        fullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        self.setPosition(board, whiteToMove, castling, enPassantCol, halfmoveClock, fullmoveNumber)
+
+    def getFen(self):
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for piece in row:
+                if piece == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1].upper() if piece[0] == 'w' else piece[1].lower()
+            ranks.append(rank + (str(empty) if empty else ''))
+        castling = ''.join(char for char, right in zip('KQkq', (self.currentCastlingRights.wks, self.currentCastlingRights.wqs,
+                                                                self.currentCastlingRights.bks, self.currentCastlingRights.bqs)) if right)
+        enPassant = Move.colsToFiles[self.enPassantPossible[1]] + Move.rowsToRanks[self.enPassantPossible[0]] if self.enPassantPossible != () else '-'
+        return ' '.join(['/'.join(ranks), 'w' if self.whiteToMove else 'b', castling or '-', enPassant,
+                         str(self.halfmoveClockLog[-1]), str((self.startPly + len(self.moveLog)) // 2 + 1)])
+
+    def snapshot(self):
+        '''
+        Immutable copy of the current position without any history, pickles to about 100 bytes
+        '''
+        return Snapshot(self.packBoard(), self.whiteToMove, self.currentCastlingRights.toBits(), self.getEnPassantCol(),
+                        self.halfmoveClockLog[-1], (self.startPly + len(self.moveLog)) // 2 + 1, self.getZobristKey())
+
+    @staticmethod
+    def fromSnapshot(snapshot):
+        gs = GameState()
+        gs.loadPacked(snapshot.board, snapshot.whiteToMove, snapshot.castling, snapshot.enPassantCol,
+                      snapshot.halfmoveClock, snapshot.fullmoveNumber)
+        return gs
+
+    def clone(self):
+        '''
+        Cheap copy of the current position for another thread. Only the board rows are copied and the move history
+        is left behind, so the clone can't undo past the position it was made from
+        '''
+        gs = GameState()
+        gs.setPosition([row[:] for row in self.board], self.whiteToMove, self.currentCastlingRights.toBits(), self.getEnPassantCol(),
+                       self.halfmoveClockLog[-1], (self.startPly + len(self.moveLog)) // 2 + 1)
+        return gs
+
+    def getZobristKey(self):
+        '''
+        64 bit hash of the position (board, side to move, castling rights and en passant square)
+        '''
+        key = 0
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece != '--':
+                    key ^= zobristPieces[piece][row * 8 + col]
+        key ^= zobristCastling[self.currentCastlingRights.toBits()]
+        if self.enPassantPossible != ():
+            key ^= zobristEnPassant[self.enPassantPossible[1]]
+        if not self.whiteToMove:
+            key ^= zobristBlackToMove
+        return key
+
+    def getEnPassantCol(self):
+        '''
+        Returns the column of the en passant square, or -1 if there isn't one
+        '''
+        return self.enPassantPossible[1] if self.enPassantPossible != () else -1
+
+
     def getValidMoves(self):
         '''
         Returns all moves considering checks
@@ -348,7 +516,7 @@ class GameState():
         if self.board[row + moveAmount][col] == '--':
             if not piecePinned or pinDirection == (moveAmount, 0):
                 if row + moveAmount == backRow: #if piece gets to back rank then it is pawn promotion
-                    pawnPromotion = True
+                    isPawnPromotion = True
                 moves.append(Move((row, col), (row + moveAmount, col), self.board, isPawnPromotion = isPawnPromotion))
                 if row == startRow and self.board[row + 2 * moveAmount][col] == '--': #2 square move
                     moves.append(Move((row, col), (row + 2 * moveAmount, col), self.board))
@@ -358,7 +526,7 @@ class GameState():
             if not piecePinned or pinDirection == (moveAmount, -1):
                 if self.board[row + moveAmount][col - 1][0] == enemyColor:
                     if row + moveAmount == backRow: #if piece gets to back rank then it is pawn promotion
-                        pawnPromotion = True
+                        isPawnPromotion = True
                     moves.append(Move((row, col), (row + moveAmount, col - 1), self.board, isPawnPromotion = isPawnPromotion))
                 if (row + moveAmount, col - 1) == self.enPassantPossible:
                     moves.append(Move((row, col), (row + moveAmount, col - 1), self.board, isEnPassantMove = True))
@@ -367,7 +535,7 @@ class GameState():
             if not piecePinned or pinDirection == (moveAmount, 1):
                 if self.board[row + moveAmount][col + 1][0] == enemyColor:
                     if row + moveAmount == backRow: #if piece gets to back rank then it is a pawn promotion
-                        pawnPromotion = True
+                        isPawnPromotion = True
                     moves.append(Move((row, col), (row + moveAmount, col + 1), self.board, isPawnPromotion = isPawnPromotion))
                 if (row + moveAmount, col + 1) == self.enPassantPossible:
                     moves.append(Move((row, col), (row + moveAmount, col + 1), self.board, isEnPassantMove = True))
@@ -384,7 +552,7 @@ class GameState():
             if self.pins[i][0] == row and self.pins[i][1] == col:
                 piecePinned = True
                 pinDirection = self.pins[i][2], self.pins[i][3]
-                if self.board[row][col][i] != 'Q': #can't remove queen from pin on rook moves, only remove it on bishop moves
+                if self.board[row][col][1] != 'Q': #can't remove queen from pin on rook moves, only remove it on bishop moves
                     self.pins.remove(self.pins[i])
                 break
         
@@ -523,6 +691,7 @@ class GameState():
                     inCheck, pins, checks = self.checkForPinsAndChecks()
                     if not inCheck:
                         moves.append(Move((row, col), (row, col + 2), self.board, isCastleMove=True))
+                self.whiteKingLocation = (row, col) #put the king back
             else:
                 self.blackKingLocation = (row, col + 1)
                 inCheck, pins, checks = self.checkForPinsAndChecks()
@@ -531,6 +700,7 @@ class GameState():
                     inCheck, pins, checks = self.checkForPinsAndChecks()
                     if not inCheck:
                         moves.append(Move((row, col), (row, col + 2), self.board, isCastleMove=True))
+                self.blackKingLocation = (row, col)
 
     def getQueensideCastleMoves(self, row, col, moves, allyColor):
         if self.board[row][col - 1] == '--' and self.board[row][col - 2] == '--' and self.board[row][col - 3] == '--':
@@ -542,14 +712,16 @@ class GameState():
                     inCheck, pins, checks = self.checkForPinsAndChecks()
                     if not inCheck:
                         moves.append(Move((row, col), (row, col - 2), self.board, isCastleMove=True))
+                self.whiteKingLocation = (row, col) #put the king back
             else:
                 self.blackKingLocation = (row, col - 1)
                 inCheck, pins, checks = self.checkForPinsAndChecks()
                 if not inCheck:
                     self.blackKingLocation = (row, col - 2)
-                    inCheck, pins, checks = self.checkForPinsAndChecks
+                    inCheck, pins, checks = self.checkForPinsAndChecks()
                     if not inCheck:
                         moves.append(Move((row, col), (row, col - 2), self.board, isCastleMove=True))
+                self.blackKingLocation = (row, col)
 
 
 class CastleRights(): #stores current state of castling rights
@@ -559,6 +731,16 @@ class CastleRights(): #stores current state of castling rights
         self.wqs = white_queenside
         self.bqs = black_queenside
 
+    def toBits(self):
+        '''
+        Packs the rights into 4 bits: white kingside, white queenside, black kingside, black queenside
+        '''
+        return int(self.wks) | int(self.wqs) << 1 | int(self.bks) << 2 | int(self.bqs) << 3
+
+    @staticmethod
+    def fromBits(bits):
+        return CastleRights(bool(bits & 1), bool(bits & 4), bool(bits & 2), bool(bits & 8))
+
 
 class Move():
     # maps keys to values
@@ -571,6 +753,8 @@ class Move():
                    "e": 4, "f": 5, "g": 6, "h": 7}
     colsToFiles = {v: k for k, v in filesToCols.items()}
 
+    promotionPieces = ['Q', 'R', 'B', 'N'] #order used when packing a move
+
     def __init__(self, startSq, endSq, board, isPawnPromotion = False, isEnPassantMove = False, isCastleMove=False):
         self.startRow = startSq[0]
         self.startCol = startSq[1]
@@ -591,6 +775,8 @@ class Move():
         #castle move
         self.isCastleMove = isCastleMove
 
+        self.promotionChoice = None #piece type to promote to, makeMove asks the user if this isn't set
+
         self.moveID = self.startRow * 1000 + self.startCol * 100 + self.endRow * 10 + self.endCol #creates unique move ID
 
     def __eq__(self, other):
@@ -601,6 +787,34 @@ class Move():
             return self.moveID == other.moveID
         return False
 
+    def toInt(self):
+        '''
+        Packs the move into 16 bits: start square (6 bits), end square (6 bits), then en passant, castle and promotion flags.
+        Promotions can't also be en passant or castle moves, so for them bits 12-13 hold the promotion piece instead
+        '''
+        value = (self.startRow * 8 + self.startCol) | (self.endRow * 8 + self.endCol) << 6
+        if self.isPawnPromotion:
+            value |= 1 << 14 | self.promotionPieces.index(self.promotionChoice or 'Q') << 12
+        elif self.isEnPassantMove:
+            value |= 1 << 12
+        elif self.isCastleMove:
+            value |= 1 << 13
+        return value
+
+    @staticmethod
+    def fromInt(value, board):
+        '''
+        Rebuilds a move packed by toInt, board must be the position the move is played from
+        '''
+        start = value & 63
+        end = (value >> 6) & 63
+        if value & (1 << 14):
+            move = Move((start // 8, start % 8), (end // 8, end % 8), board, isPawnPromotion=True)
+            move.promotionChoice = Move.promotionPieces[(value >> 12) & 3]
+            return move
+        return Move((start // 8, start % 8), (end // 8, end % 8), board,
+                    isEnPassantMove=bool(value & (1 << 12)), isCastleMove=bool(value & (1 << 13)))
+
     def getChessNotation(self):
         return self.getRankFile(self.startRow, self.startCol) + self.getRankFile(self.endRow, self.endCol)
     
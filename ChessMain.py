@@ -2,8 +2,12 @@
 This is the main driver file, for user input and GameState object
 '''
 
+import os
+import queue
 import pygame as p  
 import ChessEngine
+import ChessAI
+import ChessDatabase
 
 p.init()
 
@@ -13,6 +17,18 @@ SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15 #for animations later
 IMAGES = {}
 
+AI_DEPTH = 5 #deepest search the computer player will do
+AI_TIME = 3 #seconds the computer player thinks per move
+PONDER = True #let the computer keep thinking during the human's turn
+
+PANEL_WIDTH = 288 #analysis panel to the right of the board
+ANALYSIS_LINES = 3 #number of best lines shown while analysing
+ANALYSIS_REFRESH = 250 #milliseconds between panel updates, so redrawing never competes with the search
+PV_MOVES_SHOWN = 8
+
+DATABASE_DIR = 'games' #position index built with ChessDatabase.py, its move statistics are shown in the panel
+DATABASE_MOVES_SHOWN = 8
+
 
 def load_images():
     '''
@@ -31,7 +47,7 @@ def main():
     Main driver for our code. Will handle user input and updating graphics
     '''
 
-    screen = p.display.set_mode((WIDTH, HEIGHT))
+    screen = p.display.set_mode((WIDTH + PANEL_WIDTH, HEIGHT))
     clock = p.time.Clock()
     screen.fill(p.Color('white'))
     gs = ChessEngine.GameState()
@@ -46,20 +62,42 @@ def main():
     playerClicks = [] #keep track of player clicks (two tuples: [(6,4), (4,4)])
     
     gameOver = False #flag for whenever 
+
+    playerOne = True #True if a human is playing white, False if the computer is
+    playerTwo = False #same as above but for black
+    searcher = ChessAI.Searcher() #keeps its tables between moves
+    aiThinking = False #flag for when the computer's search for the current move is running
+
+    analysisMode = False #toggled with 'a', both sides are played by hand and the panel shows the best lines
+    analysisQueue = queue.Queue() #(depth, lines) published by the searching thread
+    analysisDepth = 0
+    analysisLines = [] #(score, principal variation) for the position analysis was started from
+    analysisWhiteToMove = True #side to move in that position, scores are for that side
+    selectedLine = 0 #line to step through with the arrow keys
+    pvStep = 0 #number of moves of the selected line currently played on the board
+    lastPanelUpdate = 0
+    panelFont = p.font.SysFont("Helvetica", 14, False, False)
+    panelSurfaces = renderAnalysisPanel(panelFont, analysisMode, analysisDepth, analysisLines, analysisWhiteToMove, selectedLine, pvStep)
+
+    database = ChessDatabase.PositionIndex(DATABASE_DIR) if os.path.exists(os.path.join(DATABASE_DIR, ChessDatabase.RUNS_FILE)) else None
+    statsSurfaces = renderMoveStats(panelFont, database.lookup(gs)) if database else []
     
     while running:
+        humanTurn = analysisMode or (gs.whiteToMove and playerOne) or (not gs.whiteToMove and playerTwo)
         for e in p.event.get():
             if e.type == p.QUIT:
                 running = False
 
             #mouse handler
             elif e.type == p.MOUSEBUTTONDOWN: #could add click and drag later
-                if not gameOver:
+                if not gameOver and humanTurn:
                     location = p.mouse.get_pos() #(x, y) location of mouse
                     col = location[0] // SQ_SIZE
                     row = location[1] // SQ_SIZE
                     
-                    if sqSelected == (row, col): #the user clicked the same square twice
+                    if col >= DIMENSION: #clicked on the analysis panel
+                        pass
+                    elif sqSelected == (row, col): #the user clicked the same square twice
                         sqSelected = ()
                         playerClicks = []
                     else:
@@ -73,8 +111,17 @@ def main():
                         for i in range(len(validMoves)):
                             if move == validMoves[i]:
                                 gs.makeMove(validMoves[i])
+                                if searcher.pondering:
+                                    ponderHit = validMoves[i] == searcher.ponderingOn and (not validMoves[i].isPawnPromotion or
+                                                validMoves[i].promotionChoice == searcher.ponderingOn.promotionChoice) #== ignores the promotion piece
+                                    if ponderHit: #the running search is for this position
+                                        searcher.ponderHit()
+                                        aiThinking = True
+                                    else:
+                                        searcher.stop()
                                 moveMade = True
                                 animate = True
+                                pvStep = 0 #moves stepped through are now part of the game
                                 sqSelected = () #reset user clicks
                                 playerClicks = []
                         if not moveMade:
@@ -83,10 +130,15 @@ def main():
             # key handlers
             elif e.type == p.KEYDOWN:
                 if e.key == p.K_z: #undo when 'z' is pressed
+                    searcher.stop()
+                    aiThinking = False
+                    pvStep = 0
                     gs.undoMove()
                     moveMade = True
                     animate = False
                 if e.key == p.K_r: #reset the board when 'r' is pressed
+                    searcher.stop()
+                    aiThinking = False
                     gs = ChessEngine.GameState()
                     validMoves = gs.getValidMoves()
                     sqSelected = ()
@@ -94,6 +146,62 @@ def main():
                     moveMade = False
                     animate = False
                     gameOver = False
+                    pvStep = 0
+                    statsSurfaces = renderMoveStats(panelFont, database.lookup(gs)) if database else []
+                    if analysisMode:
+                        analysisLines = startAnalysis(searcher, gs, analysisQueue)
+                        analysisWhiteToMove = gs.whiteToMove
+                        analysisDepth = 0
+                if e.key == p.K_a: #toggle analysis mode when 'a' is pressed
+                    analysisMode = not analysisMode
+                    aiThinking = False
+                    pvStep = 0
+                    selectedLine = 0
+                    searcher.stop()
+                    analysisLines = startAnalysis(searcher, gs, analysisQueue) if analysisMode else []
+                    analysisWhiteToMove = gs.whiteToMove
+                    analysisDepth = 0
+                if analysisMode and pvStep == 0 and e.key in (p.K_UP, p.K_DOWN) and len(analysisLines) > 0: #choose a line
+                    selectedLine = (selectedLine + (1 if e.key == p.K_DOWN else -1)) % len(analysisLines)
+                if analysisMode and e.key == p.K_RIGHT and selectedLine < len(analysisLines): #play the next move of the line
+                    line = analysisLines[selectedLine][1]
+                    if pvStep < len(line):
+                        if pvStep == 0:
+                            searcher.stop() #keep the lines as they are while stepping
+                            while not analysisQueue.empty(): #lines published before the search stopped would replace them
+                                analysisQueue.get_nowait()
+                        for move in validMoves:
+                            if move == line[pvStep]:
+                                move.promotionChoice = line[pvStep].promotionChoice
+                                gs.makeMove(move)
+                                pvStep += 1
+                                moveMade = True
+                                animate = True
+                                break
+                if analysisMode and e.key == p.K_LEFT and pvStep > 0: #take back a move of the line
+                    gs.undoMove()
+                    pvStep -= 1
+                    moveMade = True
+                    gameOver = False
+                panelSurfaces = renderAnalysisPanel(panelFont, analysisMode, analysisDepth, analysisLines, analysisWhiteToMove, selectedLine, pvStep)
+
+        #computer player, searches on a background thread so the window stays responsive
+        if not gameOver and not humanTurn and not moveMade:
+            if not aiThinking:
+                searcher.startSearch(gs, AI_DEPTH, AI_TIME)
+                aiThinking = True
+            elif searcher.isDone():
+                aiMove = validMoves[0]
+                for move in validMoves:
+                    if move == searcher.bestMove:
+                        move.promotionChoice = searcher.bestMove.promotionChoice
+                        aiMove = move
+                gs.makeMove(aiMove)
+                moveMade = True
+                animate = True
+                aiThinking = False
+                if PONDER and (playerOne or playerTwo): #think on the expected reply while the human decides
+                    searcher.ponder(gs, AI_DEPTH, AI_TIME)
 
         if moveMade:
             if animate:
@@ -101,8 +209,24 @@ def main():
             validMoves = gs.getValidMoves()
             moveMade = False
             animate = False
+            if analysisMode and pvStep == 0: #analyse the new position
+                analysisLines = startAnalysis(searcher, gs, analysisQueue)
+                analysisWhiteToMove = gs.whiteToMove
+                analysisDepth = 0
+                selectedLine = 0
+            panelSurfaces = renderAnalysisPanel(panelFont, analysisMode, analysisDepth, analysisLines, analysisWhiteToMove, selectedLine, pvStep)
+            statsSurfaces = renderMoveStats(panelFont, database.lookup(gs)) if database else []
+
+        #take the newest lines from the search, at most every ANALYSIS_REFRESH milliseconds
+        if analysisMode and p.time.get_ticks() - lastPanelUpdate >= ANALYSIS_REFRESH and not analysisQueue.empty():
+            while not analysisQueue.empty():
+                analysisDepth, analysisLines = analysisQueue.get_nowait()
+            selectedLine = min(selectedLine, len(analysisLines) - 1)
+            lastPanelUpdate = p.time.get_ticks()
+            panelSurfaces = renderAnalysisPanel(panelFont, analysisMode, analysisDepth, analysisLines, analysisWhiteToMove, selectedLine, pvStep)
         
         drawGameState(screen, gs, validMoves, sqSelected)
+        drawAnalysisPanel(screen, panelSurfaces + statsSurfaces)
 
         if gs.checkmate:
             gameOver = True
@@ -214,6 +338,68 @@ def animateMove(move, screen, board, clock):
         p.display.flip()
         clock.tick(60)
 
+def startAnalysis(searcher, gs, analysisQueue):
+    '''
+    Restart the analysis on the current position, returns the (empty) lines to show until the first depth is done
+    '''
+    searcher.stop()
+    while not analysisQueue.empty(): #drop lines from the old position
+        analysisQueue.get_nowait()
+    searcher.analyse(gs, ANALYSIS_LINES, lambda depth, lines: analysisQueue.put((depth, lines)))
+    return []
+
+def formatScore(score, whiteToMove):
+    '''
+    Score for the side to move as text from white's point of view, e.g. '+0.35' or '#-3' when black mates in 3
+    '''
+    if not whiteToMove:
+        score = -score
+    if abs(score) >= ChessAI.CHECKMATE - ChessAI.MAX_PLY:
+        mateIn = (ChessAI.CHECKMATE - abs(score) + 1) // 2
+        return '#' + str(mateIn) if score > 0 else '#-' + str(mateIn)
+    return '%+.2f' % (score / 100)
+
+def renderAnalysisPanel(font, analysisMode, depth, lines, whiteToMove, selectedLine, pvStep):
+    '''
+    Render the panel text once per update instead of every frame. The moves already stepped through are shown in blue
+    '''
+    if not analysisMode:
+        return [font.render("Press 'a' to analyse", True, p.Color('Black'))]
+    surfaces = [font.render('Depth %d  (up/down choose, left/right step)' % depth, True, p.Color('Black'))]
+    for i in range(len(lines)):
+        score, line = lines[i]
+        marker = '> ' if i == selectedLine else '   '
+        surfaces.append(font.render(marker + str(i + 1) + '.  ' + formatScore(score, whiteToMove), True, p.Color('Black')))
+        played = line[:pvStep] if i == selectedLine else []
+        rest = line[len(played):max(PV_MOVES_SHOWN, len(played))]
+        surfaces.append((font.render('     ' + ' '.join(move.getChessNotation() for move in played), True, p.Color('Blue')),
+                         font.render(' ' + ' '.join(move.getChessNotation() for move in rest), True, p.Color('Black'))))
+    return surfaces
+
+def renderMoveStats(font, stats):
+    '''
+    Render the games database statistics for the current position: games, then white wins / draws / black wins
+    '''
+    surfaces = [font.render('', True, p.Color('Black')), font.render('Games database', True, p.Color('Black'))]
+    if len(stats) == 0:
+        surfaces.append(font.render('   no games reached this position', True, p.Color('Gray')))
+    for move, white, draw, black in stats[:DATABASE_MOVES_SHOWN]:
+        games = white + draw + black
+        surfaces.append(font.render('   %s  %d   %d%% / %d%% / %d%%' % (move.getChessNotation(), games, 100 * white // games,
+                                                                       100 * draw // games, 100 * black // games), True, p.Color('Black')))
+    return surfaces
+
+def drawAnalysisPanel(screen, surfaces):
+    p.draw.rect(screen, p.Color('white'), p.Rect(WIDTH, 0, PANEL_WIDTH, HEIGHT))
+    y = 8
+    for surface in surfaces:
+        if isinstance(surface, tuple): #moves already played, then the rest of the line
+            screen.blit(surface[0], (WIDTH + 8, y))
+            screen.blit(surface[1], (WIDTH + 8 + surface[0].get_width(), y))
+        else:
+            screen.blit(surface, (WIDTH + 8, y))
+        y += surface[0].get_height() + 4 if isinstance(surface, tuple) else surface.get_height() + 4
+
 def drawText(screen, text):
     font = p.font.SysFont("Helvetica", 32, True, False)
     textObject = font.render(text, 0, p.Color('Gray'))
@@ -0,0 +1,243 @@
+'''
+Asyncio server hosting many concurrent games over a line protocol.
+
+Each session only keeps a position snapshot (GameState.snapshot) and an array of packed moves (Move.toInt).
+A GameState is built from them just for the time it takes to handle a request. Engine searches are queued
+and run in a process pool, each one limited by what is left of its session's clock.
+
+One command per line, every command gets a one line reply:
+    new [seconds]       start a game, seconds is the engine's clock (default 300). Replies "ok <id>"
+    move <id> <e2e4>    play a move, add q, r, b or n for a promotion. Replies "ok", "ok checkmate", "ok stalemate" or "error ..."
+    go <id>             the engine plays the side to move. Replies "bestmove <move>" like move does, e.g. "bestmove e7e5 checkmate"
+    moves <id>          the moves played so far
+    close <id>          end the session, sessions also end when the connection that created them closes
+    stats               number of sessions, bytes per session, search queue length and latency percentiles
+
+Usage: python ChessServer.py [--host 127.0.0.1] [--port 8765] [--unix path] [--workers N] [--tt-size N]
+'''
+
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import ChessAI
+import ChessEngine
+
+DEFAULT_CLOCK = 300.0 #seconds of engine thinking time per game
+MOVES_TO_GO = 30 #the engine spends clock / MOVES_TO_GO on a move
+MIN_MOVE_TIME = 0.05
+MAX_MOVE_TIME = 10.0
+MAX_DEPTH = 6
+LATENCY_SAMPLES = 10000
+WORKER_TT_SIZE = 1 << 18 #transposition table slots of each worker process, every worker has its own table
+
+workerSearcher = None #Searcher of a worker process, created by initWorker
+
+
+def initWorker(ttSize):
+    global workerSearcher
+    workerSearcher = ChessAI.Searcher(ttSize)
+
+
+def searchPosition(snapshot, timeLimit):
+    '''
+    Runs in a worker process: returns the packed best move for the snapshot, or None if there are no moves
+    '''
+    gs = ChessEngine.GameState.fromSnapshot(snapshot)
+    move = workerSearcher.findBestMove(gs, gs.getValidMoves(), MAX_DEPTH, timeLimit)
+    return move.toInt() if move is not None else None
+
+
+class Session(): #everything the server keeps about one game
+    __slots__ = ('position', 'moves', 'clock', 'busy')
+
+    def __init__(self, clock):
+        self.position = ChessEngine.GameState().snapshot()
+        self.moves = array('H')
+        self.clock = clock
+        self.busy = False
+
+    def toGameState(self):
+        return ChessEngine.GameState.fromSnapshot(self.position)
+
+    def play(self, gs, move):
+        '''
+        Make move on gs (built with toGameState) and store the result. Returns '', ' checkmate' or ' stalemate'
+        '''
+        gs.makeMove(move)
+        self.moves.append(move.toInt())
+        self.position = gs.snapshot()
+        gs.getValidMoves()
+        return ' checkmate' if gs.checkmate else ' stalemate' if gs.stalemate else ''
+
+    def memoryUsage(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.moves) + sys.getsizeof(self.position) + sum(sys.getsizeof(field) for field in self.position)
+
+
+def findMove(gs, text):
+    '''
+    Returns the valid move written as e.g. 'e2e4' or 'e7e8q', or None
+    '''
+    for move in gs.getValidMoves():
+        if move.getChessNotation() == text[:4]:
+            if move.isPawnPromotion:
+                move.promotionChoice = text[4].upper() if len(text) == 5 and text[4].upper() in ChessEngine.Move.promotionPieces else 'Q'
+            return move
+    return None
+
+
+def moveText(move):
+    '''
+    The move written the way findMove reads it, e.g. 'e2e4' or 'e7e8q'
+    '''
+    return move.getChessNotation() + (move.promotionChoice.lower() if move.isPawnPromotion and move.promotionChoice else '')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class GameServer():
+    def __init__(self, workers=None, ttSize=WORKER_TT_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.ttSize = ttSize
+        self.sessions = {}
+        self.nextId = itertools.count(1)
+        self.latencies = {'move': deque(maxlen=LATENCY_SAMPLES), 'go': deque(maxlen=LATENCY_SAMPLES)}
+        self.pool = None
+        self.searchQueue = None
+        self.dispatchers = []
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(self.workers, initializer=initWorker, initargs=(self.ttSize,))
+        self.searchQueue = asyncio.Queue()
+        self.dispatchers = [asyncio.create_task(self.dispatchSearches()) for _ in range(self.workers)]
+
+    async def dispatchSearches(self):
+        '''
+        Feeds queued searches to the process pool, one at a time per worker process
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            session, future = await self.searchQueue.get()
+            timeLimit = max(MIN_MOVE_TIME, min(session.clock / MOVES_TO_GO, MAX_MOVE_TIME))
+            start = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(self.pool, searchPosition, session.position, timeLimit)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            session.clock = max(0.0, session.clock - (time.perf_counter() - start))
+
+    async def handleClient(self, reader, writer):
+        owned = set() #ids of the sessions this connection created
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                words = line.decode(errors='replace').split()
+                try:
+                    reply = await self.handleCommand(words, owned)
+                except (ValueError, IndexError, KeyError):
+                    reply = 'error bad command'
+                except Exception as e: #e.g. a search that failed in a worker or a broken pool
+                    reply = 'error %s' % (type(e).__name__)
+                if words and words[0] in self.latencies and not reply.startswith('error'):
+                    self.latencies[words[0]].append(time.perf_counter() - start)
+                writer.write(reply.encode() + b'\n')
+                await writer.drain()
+        finally:
+            for sessionId in owned: #don't keep games of clients that left without closing them
+                self.sessions.pop(sessionId, None)
+            writer.close()
+
+    async def handleCommand(self, words, owned):
+        command = words[0]
+        if command == 'new':
+            sessionId = next(self.nextId)
+            self.sessions[sessionId] = Session(float(words[1]) if len(words) > 1 else DEFAULT_CLOCK)
+            owned.add(sessionId)
+            return 'ok %d' % sessionId
+        if command == 'stats':
+            return self.stats()
+
+        session = self.sessions[int(words[1])]
+        if command == 'close':
+            del self.sessions[int(words[1])]
+            owned.discard(int(words[1]))
+            return 'ok'
+        if command == 'moves':
+            gs = ChessEngine.GameState()
+            notation = []
+            for value in session.moves:
+                move = ChessEngine.Move.fromInt(value, gs.board)
+                notation.append(moveText(move))
+                gs.makeMove(move)
+            return ' '.join(notation)
+        if session.busy:
+            return 'error busy'
+        if command == 'move':
+            gs = session.toGameState()
+            move = findMove(gs, words[2])
+            if move is None:
+                return 'error illegal move'
+            return 'ok' + session.play(gs, move)
+        if command == 'go':
+            session.busy = True
+            try:
+                future = asyncio.get_running_loop().create_future()
+                await self.searchQueue.put((session, future))
+                value = await future
+            finally:
+                session.busy = False
+            if value is None:
+                return 'error game over'
+            gs = session.toGameState()
+            move = ChessEngine.Move.fromInt(value, gs.board)
+            return 'bestmove ' + moveText(move) + session.play(gs, move)
+        return 'error unknown command'
+
+    def stats(self):
+        memory = sum(session.memoryUsage() for session in self.sessions.values())
+        parts = ['sessions %d' % len(self.sessions),
+                 'bytes/session %d' % (memory // len(self.sessions) if self.sessions else 0),
+                 'queue %d' % self.searchQueue.qsize()]
+        for command, samples in self.latencies.items():
+            parts.append('%s p50 %.2fms p90 %.2fms p99 %.2fms' % (command, 1000 * percentile(samples, 0.5),
+                         1000 * percentile(samples, 0.9), 1000 * percentile(samples, 0.99)))
+        return ' '.join(parts)
+
+
+async def serve(host, port, unixPath, workers, ttSize):
+    server = GameServer(workers, ttSize)
+    await server.start()
+    if unixPath:
+        listener = await asyncio.start_unix_server(server.handleClient, unixPath)
+    else:
+        listener = await asyncio.start_server(server.handleClient, host, port)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve many chess games over a line protocol')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='listen on a unix socket instead of tcp')
+    parser.add_argument('--workers', type=int, default=None, help='engine processes, defaults to the number of cores')
+    parser.add_argument('--tt-size', type=int, default=WORKER_TT_SIZE, help='transposition table slots per engine process')
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.tt_size))
+
+
+if __name__ == "__main__":
+    main()
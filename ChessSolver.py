@@ -0,0 +1,244 @@
+'''
+Depth-first proof-number search for forced mates.
+
+solveMate decides whether the side to move can force mate in at most N moves and returns the mating line.
+The search is df-pn (Nagai) with the 1 + epsilon trick: every node has a proof number phi and a disproof number
+delta from the point of view of its side to move, and the search always follows the most proving child until
+its thresholds are exceeded. Nodes are keyed by (Zobrist key, plies left), so the same position with a
+different number of moves left is a different node and the search graph has no cycles.
+
+The table of proof and disproof numbers holds at most maxEntries positions. When it is full, the half of the
+entries with the smallest subtrees is thrown away, since those are the cheapest to search again.
+
+Usage: python ChessSolver.py <file with one FEN per line> [--moves N] [--nodes N] [--workers N]
+'''
+
+import argparse
+import copy
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ChessEngine
+
+MATE = 'mate'
+NO_MATE = 'no mate'
+UNKNOWN = 'unknown' #ran out of nodes before deciding
+
+INFINITY = 10 ** 8
+EPSILON = 0.25 #widens child thresholds so the search doesn't keep switching between two children
+MAX_ENTRIES = 1 << 20
+MAX_NODES = 200000
+
+
+class NodeLimit(Exception):
+    pass
+
+
+def expandPromotions(moves):
+    '''
+    getValidMoves gives one move per promotion square, the solver needs one per promotion piece
+    '''
+    expanded = []
+    for move in moves:
+        if move.isPawnPromotion:
+            for piece in ChessEngine.Move.promotionPieces:
+                promotion = copy.copy(move)
+                promotion.promotionChoice = piece
+                expanded.append(promotion)
+        else:
+            expanded.append(move)
+    return expanded
+
+
+def moveText(move):
+    return move.getChessNotation() + (move.promotionChoice.lower() if move.isPawnPromotion else '')
+
+
+class MateSolver():
+    def __init__(self, maxEntries=MAX_ENTRIES):
+        self.maxEntries = maxEntries
+        self.table = {} #(zobrist key, plies left) -> (phi, delta, nodes searched below it)
+        self.nodes = 0
+        self.maxNodes = MAX_NODES
+
+    def solve(self, gs, maxMoves, maxNodes=MAX_NODES):
+        '''
+        Returns (MATE, line), (NO_MATE, []) or (UNKNOWN, []). Tries mate in 1, 2, ... so the mate found is the shortest.
+        gs is not changed
+        '''
+        position = gs.clone()
+        self.nodes = 0
+        self.maxNodes = maxNodes
+        try:
+            for moves in range(1, maxMoves + 1):
+                plies = 2 * moves - 1
+                phi, delta = self.search(position, plies, INFINITY, INFINITY)
+                if phi == 0:
+                    return MATE, self.matingLine(position, plies)
+        except NodeLimit:
+            return UNKNOWN, []
+        return NO_MATE, []
+
+    def search(self, gs, plies, thresholdPhi, thresholdDelta):
+        '''
+        Expand the node until its phi or delta reaches the threshold, returns (phi, delta)
+        '''
+        self.nodes += 1
+        if self.nodes > self.maxNodes:
+            raise NodeLimit()
+        key = (gs.getZobristKey(), plies)
+        attacker = plies % 2 == 1 #the attacker moves when an odd number of plies is left
+        moves = gs.getValidMoves()
+        if len(moves) == 0: #the side to move loses, unless it is the defender and it's stalemate
+            return self.store(key, INFINITY, 0, 1) if attacker or gs.checkmate else self.store(key, 0, INFINITY, 1)
+        if plies == 0:
+            return self.store(key, 0, INFINITY, 1) #defender survived every move
+
+        children = [] #(move, key, gives check)
+        for move in expandPromotions(moves):
+            gs.makeMove(move)
+            check = gs.checkForPinsAndChecks()[0]
+            childKey = (gs.getZobristKey(), plies - 1)
+            gs.undoMove()
+            if attacker and plies == 1 and not check:
+                continue #only a check can mate on the last move
+            children.append((move, childKey, check))
+        if len(children) == 0:
+            return self.store(key, INFINITY, 0, 1)
+        if attacker:
+            children.sort(key=lambda child: not child[2]) #checks first
+
+        startNodes = self.nodes
+        while True:
+            phi = INFINITY
+            delta = 0
+            best = None
+            bestDelta = secondDelta = INFINITY
+            bestPhi = 0
+            for child in children:
+                childPhi, childDelta = self.lookup(child[1], attacker and not child[2])
+                delta = min(INFINITY, delta + childPhi)
+                if childDelta < bestDelta:
+                    secondDelta = bestDelta
+                    bestDelta = childDelta
+                    bestPhi = childPhi
+                    best = child
+                elif childDelta < secondDelta:
+                    secondDelta = childDelta
+            phi = bestDelta
+            if phi >= thresholdPhi or delta >= thresholdDelta:
+                break
+            childThresholdPhi = min(INFINITY, thresholdDelta - delta + bestPhi)
+            childThresholdDelta = min(thresholdPhi, int(secondDelta * (1 + EPSILON)) + 1)
+            gs.makeMove(best[0])
+            self.search(gs, plies - 1, childThresholdPhi, childThresholdDelta)
+            gs.undoMove()
+        return self.store(key, phi, delta, self.nodes - startNodes + 1)
+
+    def lookup(self, key, quiet):
+        entry = self.table.get(key)
+        if entry is not None:
+            return entry[0], entry[1]
+        return (1, 2) if quiet else (1, 1) #a quiet attacking move starts out less promising than a check
+
+    def store(self, key, phi, delta, work):
+        if key not in self.table and len(self.table) >= self.maxEntries:
+            self.collectGarbage()
+        self.table[key] = (phi, delta, work)
+        return phi, delta
+
+    def collectGarbage(self):
+        '''
+        Drop the half of the table with the smallest subtrees
+        '''
+        entries = sorted(self.table.items(), key=lambda item: item[1][2])
+        for key, entry in entries[:len(entries) // 2]:
+            del self.table[key]
+
+    def entry(self, gs, plies):
+        key = (gs.getZobristKey(), plies)
+        if key not in self.table: #thrown away by garbage collection, search it again
+            self.search(gs, plies, INFINITY, INFINITY)
+        return self.table[key]
+
+    def provenMove(self, gs, moves, plies):
+        '''
+        An attacking move whose stored entry is already proven, or None if garbage collection threw them all away
+        '''
+        for move in moves:
+            gs.makeMove(move)
+            entry = self.table.get((gs.getZobristKey(), plies - 1))
+            gs.undoMove()
+            if entry is not None and entry[1] == 0:
+                return move
+        return None
+
+    def matingLine(self, gs, plies):
+        '''
+        Follow a proven root: the attacker plays a move that wins, the defender the reply with the biggest proof tree
+        '''
+        line = []
+        while plies > 0:
+            moves = expandPromotions(gs.getValidMoves())
+            best = self.provenMove(gs, moves, plies) if plies % 2 == 1 else None
+            bestWork = -1
+            for move in moves if best is None else []:
+                gs.makeMove(move)
+                phi, delta, work = self.entry(gs, plies - 1)
+                gs.undoMove()
+                if plies % 2 == 1:
+                    if delta == 0: #the defender loses after this move
+                        best = move
+                        break
+                elif work > bestWork:
+                    best = move
+                    bestWork = work
+            if best is None:
+                break #defender is mated
+            line.append(best)
+            gs.makeMove(best)
+            plies -= 1
+        for i in range(len(line)):
+            gs.undoMove()
+        return line
+
+
+def solveMate(gs, maxMoves, maxNodes=MAX_NODES, maxEntries=MAX_ENTRIES):
+    return MateSolver(maxEntries).solve(gs, maxMoves, maxNodes)
+
+
+def solveFen(fen, maxMoves, maxNodes):
+    '''
+    Solve one puzzle, returns (fen, result, mating line in notation, seconds). Used by the process pool in solveBatch
+    '''
+    start = time.time()
+    gs = ChessEngine.GameState()
+    gs.loadFen(fen)
+    result, line = solveMate(gs, maxMoves, maxNodes)
+    return fen, result, [moveText(move) for move in line], time.time() - start
+
+
+def solveBatch(fens, maxMoves, maxNodes=MAX_NODES, workers=None):
+    '''
+    Solve many puzzles across processes, yields solveFen results in the order of fens
+    '''
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(solveFen, fens, [maxMoves] * len(fens), [maxNodes] * len(fens))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find forced mates with proof-number search')
+    parser.add_argument('puzzles', help='file with one FEN per line')
+    parser.add_argument('--moves', type=int, default=10, help='longest mate to look for, in moves')
+    parser.add_argument('--nodes', type=int, default=MAX_NODES, help='node limit per puzzle')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.puzzles) as f:
+        fens = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    for fen, result, line, seconds in solveBatch(fens, args.moves, args.nodes, args.workers):
+        print('%s | %s %s (%.2fs)' % (fen, result, ' '.join(line), seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+'''
+Texel-style tuning of the evaluation weights in ChessAI.
+
+Every labelled position from a ChessData directory becomes a sparse feature vector with one material
+feature and one piece-square feature per piece (+1 for white, -1 for black), so that the dot product with
+the weight vector is exactly ChessAI.scoreMaterial. The weights are fit with Adam on the squared error
+between the game result and the win probability 1 / (1 + 10^(-K * score / 400)).
+
+Whole batches are handled with numpy: the sparse products are done with np.bincount, never per position.
+
+Usage: python ChessTuner.py <data directory> [--epochs N] [--out weights.json]
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+import ChessAI
+import ChessData
+
+NUM_FEATURES = 6 + 6 * 64 #material per piece type, then a 64 square table per piece type
+LN10 = np.log(10.0)
+
+
+def extractFeatures(records):
+    '''
+    Sparse features of a batch of records: (position index, feature index, sign) triples plus the targets
+    '''
+    squares = ChessData.decodeBoards(records)
+    positions, squareIds = np.nonzero(squares)
+    codes = squares[positions, squareIds].astype(np.int64)
+    types = (codes & 7) - 1
+    black = codes >> 3
+    relativeSquares = np.where(black == 1, squareIds ^ 56, squareIds) #flip the row for black pieces
+    signs = (1 - 2 * black).astype(np.float64)
+    rows = np.concatenate([positions, positions])
+    cols = np.concatenate([types, 6 + types * 64 + relativeSquares])
+    targets = (records['result'].astype(np.float64) + 1) / 2
+    return rows, cols, np.concatenate([signs, signs]), targets
+
+
+def weightsFromTables():
+    weights = np.zeros(NUM_FEATURES)
+    for t, piece in enumerate(ChessAI.PIECE_TYPES):
+        weights[t] = ChessAI.pieceScores[piece]
+        weights[6 + t * 64:6 + (t + 1) * 64] = np.array(ChessAI.pieceSquareScores[piece]).ravel()
+    return weights
+
+
+def tablesFromWeights(weights):
+    '''
+    Copy a weight vector into ChessAI's material values and piece-square tables, rounded to centipawns
+    '''
+    rounded = np.rint(weights).astype(int)
+    for t, piece in enumerate(ChessAI.PIECE_TYPES):
+        ChessAI.pieceScores[piece] = int(rounded[t])
+        ChessAI.pieceSquareScores[piece] = rounded[6 + t * 64:6 + (t + 1) * 64].reshape(8, 8).tolist()
+
+
+def predict(features, weights, scale):
+    rows, cols, signs, targets = features
+    scores = np.bincount(rows, signs * weights[cols], minlength=len(targets))
+    return 1 / (1 + np.power(10.0, -scale * scores / 400))
+
+
+def loss(features, weights, scale):
+    return np.mean((features[3] - predict(features, weights, scale)) ** 2)
+
+
+def gradient(features, weights, scale):
+    rows, cols, signs, targets = features
+    p = predict(features, weights, scale)
+    dScores = -2 * (targets - p) * p * (1 - p) * scale * LN10 / 400 / len(targets)
+    return np.bincount(cols, signs * dScores[rows], minlength=NUM_FEATURES)
+
+
+def fitScale(features, weights):
+    '''
+    Pick the K that best maps the current scores to results, so tuning only moves the weights
+    '''
+    candidates = np.linspace(0.2, 3.0, 57)
+    return float(candidates[np.argmin([loss(features, weights, k) for k in candidates])])
+
+
+def tune(directory, epochs=4, batchSize=1 << 14, learningRate=1.0, scale=None, seed=0, verbose=True):
+    '''
+    Fit the evaluation weights to the positions in directory and return the weight vector
+    '''
+    loader = ChessData.ShardLoader(directory, batchSize=batchSize, seed=seed, transform=extractFeatures)
+    weights = weightsFromTables()
+    if scale is None:
+        scale = fitScale(next(iter(loader)), weights)
+    if verbose:
+        print('%d positions, K = %.2f' % (len(loader), scale))
+
+    #Adam state
+    m = np.zeros(NUM_FEATURES)
+    v = np.zeros(NUM_FEATURES)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    step = 0
+    for epoch in range(epochs):
+        start = time.time()
+        totalLoss = 0.0
+        batches = 0
+        for features in loader.batches(epoch):
+            g = gradient(features, weights, scale)
+            step += 1
+            m = beta1 * m + (1 - beta1) * g
+            v = beta2 * v + (1 - beta2) * g * g
+            weights -= learningRate * (m / (1 - beta1 ** step)) / (np.sqrt(v / (1 - beta2 ** step)) + eps)
+            weights[5] = 0 #king material cancels out, keep it fixed
+            totalLoss += loss(features, weights, scale)
+            batches += 1
+        if verbose:
+            print('epoch %d: loss %.6f (%.1fs)' % (epoch + 1, totalLoss / max(batches, 1), time.time() - start))
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune evaluation weights on a ChessData directory')
+    parser.add_argument('data')
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=1 << 14)
+    parser.add_argument('--lr', type=float, default=1.0)
+    parser.add_argument('--scale', type=float, default=None, help='K in the win probability, fitted if not given')
+    parser.add_argument('--out', default=ChessAI.WEIGHTS_FILE)
+    args = parser.parse_args()
+
+    weights = tune(args.data, args.epochs, args.batch_size, args.lr, args.scale)
+    tablesFromWeights(weights)
+    ChessAI.saveWeights(args.out)
+    print('weights written to ' + args.out)
+
+
+if __name__ == "__main__":
+    main()